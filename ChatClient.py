@@ -1,13 +1,102 @@
-from typing import List, Dict, Optional, Iterator
+from typing import (
+    List,
+    Dict,
+    Optional,
+    Iterator,
+    Tuple,
+    BinaryIO,
+    Deque,
+    MutableSequence,
+    Sequence,
+)
+import asyncio
+import collections
+import hashlib
 import json
 import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from dataclasses import dataclass
-from openai import OpenAI
-from functools import singledispatchmethod
+from openai import OpenAI, AsyncOpenAI, BadRequestError, NotFoundError
+from functools import partial, singledispatchmethod
+
+# 新版 openai 基于 httpx2，旧版基于 httpx，两者都无法导入时由 SDK 自行创建连接
+try:
+    import httpx2 as httpx
+except ImportError:
+    try:
+        import httpx
+    except ImportError:
+        httpx = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，捕获后者即可
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# 按 (api_key, base_url) 缓存的 client，切换模型时复用已有连接
+_CLIENT_CACHE: Dict[Tuple[str, str], OpenAI] = {}
+_shared_http_client: Optional["httpx.Client"] = None
+# 并行获取模型列表时，保证每个 (api_key, base_url) 只创建一个 client
+_CLIENT_LOCK = threading.Lock()
+# 服务端不支持 completions 接口时返回的错误，此时退化为 chat 接口
+_COMPLETIONS_UNSUPPORTED_ERRORS = (NotFoundError, BadRequestError)
+# 连接错误、429 及 5xx 的重试交给 SDK，按指数退避最多重试的次数
+_MAX_RETRIES = 2
+
+
+def _get_shared_http_client() -> Optional["httpx.Client"]:
+    """
+    获取所有 OpenAI client 共享的 httpx.Client，未安装 h2 时退化为 HTTP/1.1
+    httpx 无法导入时返回None
+    """
+    global _shared_http_client
+    if _shared_http_client is None and httpx is not None:
+        limits = httpx.Limits(max_keepalive_connections=32, max_connections=64)
+        try:
+            _shared_http_client = httpx.Client(http2=True, limits=limits)
+        except ImportError:
+            _shared_http_client = httpx.Client(limits=limits)
+    return _shared_http_client
+
+
+def _get_client(api_key: str, base_url: str) -> OpenAI:
+    """获取缓存的 OpenAI client，不存在或已被关闭时创建"""
+    key = (api_key, base_url)
+    with _CLIENT_LOCK:
+        client = _CLIENT_CACHE.get(key)
+        if client is None or client.is_closed():
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                http_client=_get_shared_http_client(),
+                max_retries=_MAX_RETRIES,
+            )
+            _CLIENT_CACHE[key] = client
+    return client
 
 
 @dataclass
 class ModelConfig:
+    # 手动声明 __slots__ 以兼容 Python 3.10 之前的版本，字段不能设置默认值
+    __slots__ = ("name", "id", "server", "url", "api_key")
+
     name: str
     id: int
     server: str
@@ -15,17 +104,160 @@ class ModelConfig:
     api_key: str
 
 
+# 每条消息除内容外额外占用的 token 数估计值
+_TOKENS_PER_MESSAGE = 4
+
+
+def _get_encoding(model_name: str):
+    """
+    获取模型对应的 tiktoken 编码
+    首次加载编码时需要联网下载 BPE 文件，未安装 tiktoken 或加载失败时返回None
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+# 按 (base_url, api_key 的哈希) 缓存的模型列表，值为 (获取时间, [(模型名称, 服务商)])
+_MODELS_CACHE: Dict[Tuple[str, str], Tuple[float, List[Tuple[str, str]]]] = {}
+_MODELS_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chatclient")
+
+
+def _models_cache_key(api_key: str, base_url: str) -> Tuple[str, str]:
+    """模型列表缓存的键，不直接保存 api_key"""
+    return base_url, hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+def _models_cache_file(key: Tuple[str, str]) -> str:
+    """模型列表在磁盘上的缓存文件路径"""
+    digest = hashlib.sha256("\n".join(key).encode("utf-8")).hexdigest()
+    return os.path.join(_MODELS_CACHE_DIR, f"models_{digest}.json")
+
+
+def _read_models_cache_file(key: Tuple[str, str]) -> Optional[Tuple[float, List]]:
+    """读取磁盘上的模型列表缓存，不存在或无法解析时返回None"""
+    try:
+        with open(_models_cache_file(key), "r", encoding="utf-8") as f:
+            cached = _json_loads(f.read())
+        return cached["timestamp"], [tuple(model) for model in cached["models"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_models_cache_file(
+    key: Tuple[str, str], timestamp: float, models: List[Tuple[str, str]]
+) -> None:
+    """将模型列表写入磁盘缓存，写入失败时忽略"""
+    try:
+        os.makedirs(_MODELS_CACHE_DIR, exist_ok=True)
+        with open(_models_cache_file(key), "w", encoding="utf-8") as f:
+            json.dump({"timestamp": timestamp, "models": models}, f)
+    except OSError:
+        pass
+
+
+def _fetch_models(
+    api_key: str, base_url: str, ttl: float, force: bool = False
+) -> List[Tuple[str, str]]:
+    """
+    获取单个API的模型列表，优先使用未过期的内存缓存和磁盘缓存
+    Args:
+        api_key: API key
+        base_url: API 地址
+        ttl: 缓存有效期，单位为秒
+        force: 为True时忽略缓存，重新请求模型列表
+    Returns:
+        [(模型名称, 服务商)] 列表
+    """
+    key = _models_cache_key(api_key, base_url)
+    if not force:
+        cached = _MODELS_CACHE.get(key) or _read_models_cache_file(key)
+        if cached and time.time() - cached[0] < ttl:
+            _MODELS_CACHE[key] = cached
+            return cached[1]
+
+    client = _get_client(api_key, base_url)
+    models = [(model.id, model.owned_by) for model in client.models.list()]
+    timestamp = time.time()
+    _MODELS_CACHE[key] = (timestamp, models)
+    _write_models_cache_file(key, timestamp, models)
+    return models
+
+
+class _ChunkReader:
+    """
+    将流式回复包装为类文件对象，供 ijson 增量解析
+    同时记录读取到的全部内容，用于写入对话历史
+    """
+
+    def __init__(self, chunks: Iterator[Optional[str]]):
+        self._chunks = chunks
+        self._parts: List[str] = []
+
+    def read(self, size: int = -1) -> bytes:
+        # ijson 会先调用 read(0) 判断返回类型，此时不能消耗数据
+        if size == 0:
+            return b""
+        for chunk in self._chunks:
+            if chunk:
+                self._parts.append(chunk)
+                return chunk.encode("utf-8")
+        return b""
+
+    def drain(self) -> str:
+        """读取剩余的全部内容，返回完整的回复"""
+        for chunk in self._chunks:
+            if chunk:
+                self._parts.append(chunk)
+        return "".join(self._parts)
+
+
 class ChatClient:
-    def __init__(self, config_path: Optional[str] = None):
+    def __init__(
+        self,
+        config_path: Optional[str] = None,
+        max_history_turns: Optional[int] = 20,
+        preserve_system: bool = True,
+        max_context_tokens: Optional[int] = None,
+        reserved_output_tokens: int = 1024,
+        models_cache_ttl: float = 3600,
+    ):
         """
         初始化ChatClient
         Args:
             config_path: 配置文件路径，如果为None则从环境变量读取
+            max_history_turns: 保留的最大对话轮数，一轮包含一问一答，为None时不限制
+                更早的消息会从对话历史中删除，get_history 也不再返回
+            preserve_system: 截断对话历史时是否保留开头的 system prompt
+            max_context_tokens: 模型的上下文长度，为None时不按 token 数截断
+            reserved_output_tokens: 为模型输出预留的 token 数
+            models_cache_ttl: 模型列表缓存的有效期，单位为秒
         """
+        self.max_history_turns = max_history_turns
+        self.preserve_system = preserve_system
+        self.max_context_tokens = max_context_tokens
+        self.reserved_output_tokens = reserved_output_tokens
+        # 按需加载的 tiktoken 编码，及其对应的模型名称
+        self._encoding = None
+        self._encoding_model: Optional[str] = None
+        self.models_cache_ttl = models_cache_ttl
+        # 已加载的服务端 (api_key, base_url)，用于刷新模型列表
+        self._servers: List[Tuple[str, str]] = []
         self.config: Dict[int, ModelConfig] = {}
-        self.conversation_history: List[Dict] = []
+        self._name_to_id: Dict[str, int] = {}
+        self.conversation_history: Deque[Dict] = self._new_history()
         self.selected_model: Optional[ModelConfig] = None
-        self.client = None
+        # 按 (api_key, base_url) 索引的 client，切换模型时无需重新创建
+        self._clients: Dict[Tuple[str, str], OpenAI] = {}
+        # 绑定了当前模型的 chat.completions.create，选择模型时生成
+        self._create = None
+        self._create_client: Optional[OpenAI] = None
 
         if config_path:
             self._load_config_from_file(config_path)
@@ -40,9 +272,9 @@ class ChatClient:
         """从文件加载配置"""
         try:
             with open(config_path, "r", encoding="utf-8") as f:
-                config = json.load(f)
+                config = _json_loads(f.read())
         except FileNotFoundError:
-            print(f"错误：配置文件 {self.config_path} 未找到")
+            print(f"错误：配置文件 {config_path} 未找到")
             exit(1)
         except json.JSONDecodeError:
             print("错误：配置文件格式不正确")
@@ -54,38 +286,126 @@ class ChatClient:
             exit(1)
 
         # server_name 暂未使用
-        for server_name, server_data in server_configs.items():
-            self._load_models_from_api(
-                server_data.get("api_key", ""), server_data.get("api_url", "")
-            )
+        self._load_models_from_apis(
+            [
+                (server_data.get("api_key", ""), server_data.get("api_url", ""))
+                for server_data in server_configs.values()
+            ]
+        )
 
     def _load_config_from_env(self) -> None:
-        """从环境变量加载配置"""
-        api_key = os.getenv("API_KEY")
-        base_url = os.getenv("BASE_URL")
+        """
+        从环境变量加载配置
+        Raises:
+            RuntimeError: 环境变量中未设置 API_KEY 或 BASE_URL
+        """
+        env = os.environ
+        api_key = env.get("API_KEY")
+        base_url = env.get("BASE_URL")
         if not api_key or not base_url:
-            print("错误：环境变量中未设置 API_KEY 或 BASE_URL")
-            exit(1)
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+            raise RuntimeError("环境变量中未设置 API_KEY 或 BASE_URL")
         self._load_models_from_api(api_key, base_url)
 
-    def _load_models_from_api(self, api_key, base_url) -> List:
+    def _load_models_from_api(self, api_key, base_url, force: bool = False) -> None:
+        """
+        从单个API加载可用模型列表，替换当前的配置
+        Args:
+            force: 为True时忽略缓存，重新请求模型列表
+        """
+        self._load_models_from_apis([(api_key, base_url)], force)
+
+    def _load_models_from_apis(
+        self, servers: List[Tuple[str, str]], force: bool = False
+    ) -> None:
+        """
+        从多个API加载可用模型列表，替换当前的配置
+        当从配置文件读取时，可能有多个服务端，各服务端的模型列表并行获取，
+        再按服务端的顺序依次加入配置，保证模型ID的分配是确定的
+        模型列表会按 models_cache_ttl 缓存在内存和磁盘中
+        所有服务端都获取成功后才会替换配置，获取失败时原有的配置保持不变
+        Args:
+            servers: (api_key, base_url) 列表
+            force: 为True时忽略缓存，重新请求模型列表
+        """
+        results = self._fetch_all_models(servers, force)
+        config, name_to_id = self._build_models(servers, results)
+        for api_key, base_url in servers:
+            self._clients[(api_key, base_url)] = _get_client(api_key, base_url)
+        self.config = config
+        self._name_to_id = name_to_id
+        self._servers = list(servers)
+
+    def _fetch_all_models(
+        self, servers: List[Tuple[str, str]], force: bool = False
+    ) -> List[List[Tuple[str, str]]]:
         """
-        从单个API加载可用模型列表到配置中
-        当从配置文件读取时，可能有多个模型配置，这个函数用于从单个API获取模型列表
+        获取多个API的模型列表
         Returns:
-            模型列表
-        """
-        client = OpenAI(api_key=api_key, base_url=base_url)
-        for model in client.models.list():
-            model_config = ModelConfig(
-                name=model.id,
-                id=len(self.config) + 1,
-                server=model.owned_by,
-                url=base_url,
-                api_key=api_key,
+            与 servers 顺序一致的 [(模型名称, 服务商)] 列表
+        """
+        if not servers:
+            return []
+        if len(servers) == 1:
+            # 单个服务端时直接获取，省去启动线程池的开销
+            api_key, base_url = servers[0]
+            return [_fetch_models(api_key, base_url, self.models_cache_ttl, force)]
+        with ThreadPoolExecutor(max_workers=min(8, len(servers))) as executor:
+            return list(
+                executor.map(
+                    lambda server: _fetch_models(
+                        *server, self.models_cache_ttl, force
+                    ),
+                    servers,
+                )
             )
-            self.config[model_config.id] = model_config
+
+    @staticmethod
+    def _build_models(
+        servers: List[Tuple[str, str]], results: List[List[Tuple[str, str]]]
+    ) -> Tuple[Dict[int, ModelConfig], Dict[str, int]]:
+        """
+        根据各服务端的模型列表构建配置，模型ID从 1 开始按顺序分配
+        Returns:
+            (模型ID到模型配置的映射, 模型名称到模型ID的索引)
+        """
+        config: Dict[int, ModelConfig] = {}
+        name_to_id: Dict[str, int] = {}
+        for (api_key, base_url), models in zip(servers, results):
+            for name, server in models:
+                model_config = ModelConfig(
+                    name=name,
+                    id=len(config) + 1,
+                    server=server,
+                    url=base_url,
+                    api_key=api_key,
+                )
+                config[model_config.id] = model_config
+                # 同名模型保留最先获取到的，与按名称查找时的行为一致
+                name_to_id.setdefault(model_config.name, model_config.id)
+        return config, name_to_id
+
+    def refresh_models(self) -> None:
+        """
+        忽略缓存，重新从所有服务端获取模型列表
+        模型ID会重新分配，若当前选择的模型仍然可用，则继续使用该模型
+        获取失败时抛出异常，原有的模型列表和选择的模型保持不变
+        """
+        selected = self.selected_model
+        self._load_models_from_apis(self._servers, force=True)
+
+        self.selected_model = None
+        if selected is not None:
+            # 同名模型可能来自多个服务端，按名称和服务端一起匹配
+            for model in self.config.values():
+                if (model.name, model.url, model.api_key) == (
+                    selected.name,
+                    selected.url,
+                    selected.api_key,
+                ):
+                    self.set_model_by_id(model.id)
+                    return
+        if self.config:
+            self.set_model_by_id(1)
 
     def get_available_models(self) -> List[Dict[str, str]]:
         """获取所有可用的模型列表"""
@@ -112,13 +432,21 @@ class ChatClient:
         Args:
             model_identifier: 模型的ID或名称
         """
-        for model in self.config.values():
-            if model_identifier == model.id:
-                self.selected_model = model
-                # 初始化对应的client
-                self.client = OpenAI(api_key=model.api_key, base_url=model.url)
-                return
-        raise ValueError(f"Model {model_identifier} not found in config")
+        model = self.config.get(model_identifier)
+        if model is None:
+            model = self.config.get(self._name_to_id.get(model_identifier))
+        if model is None:
+            raise ValueError(f"Model {model_identifier} not found in config")
+        self.selected_model = model
+        self._bind_create()
+
+    def _bind_create(self) -> None:
+        """预先绑定当前模型的请求函数，每次请求时只需传入消息等参数"""
+        self._create_client = self._selected_client()
+        self._create = partial(
+            self._create_client.chat.completions.create,
+            model=self.selected_model.name,
+        )
 
     @set_model.register
     def set_model_by_name(self, model_name: str) -> None:
@@ -127,13 +455,10 @@ class ChatClient:
         Args:
             model_identifier: 模型的名称
         """
-        for model in self.config.values():
-            if model_name == model.name:
-                self.selected_model = model
-                # 初始化对应的client
-                self.client = OpenAI(api_key=model.api_key, base_url=model.url)
-                return
-        raise ValueError(f"Model {model_name} not found in config")
+        model_id = self._name_to_id.get(model_name)
+        if model_id is None:
+            raise ValueError(f"Model {model_name} not found in config")
+        self.set_model_by_id(model_id)
 
     def set_model_by_name_and_server(
         self, model_identifier: str, server_name: str
@@ -146,14 +471,21 @@ class ChatClient:
         """
         for model in self.config.values():
             if model_identifier == model.name and server_name == model.server:
-                self.selected_model = model
-                # 初始化对应的client
-                self.client = OpenAI(api_key=model.api_key, base_url=model.url)
+                self.set_model_by_id(model.id)
                 return
         raise ValueError(
             f"Model {model_identifier} with server {server_name} not found in config"
         )
 
+    def _selected_client(self) -> OpenAI:
+        """获取当前选择的模型对应的 client"""
+        key = (self.selected_model.api_key, self.selected_model.url)
+        client = self._clients.get(key)
+        if client is None or client.is_closed():
+            # client 可能已被本实例或其他实例的 close() 关闭，此时重新建立连接
+            client = self._clients[key] = _get_client(*key)
+        return client
+
     def get_selected_model(self) -> Optional[ModelConfig]:
         """获取当前选择的模型配置"""
         return self.selected_model
@@ -172,10 +504,10 @@ class ChatClient:
 
         # 实现实际的对话逻辑
         self.conversation_history.append({"role": "user", "content": message})
+        self._trim_history()
         try:
-            response = self.client.chat.completions.create(
-                model=self.selected_model.name,
-                messages=self.conversation_history,
+            response = self._do_create(
+                list(self.conversation_history),
                 stream=False,
             )
             reply_content = response.choices[0].message.content
@@ -187,11 +519,30 @@ class ChatClient:
             print(f"API 请求失败：{str(e)}")
             return
 
-    def stream_chat(self, message: str) -> Iterator[str]:
+    def _do_create(self, msgs: List[Dict], **kwargs):
+        """
+        发送 chat completions 请求
+        临时性错误由 SDK 按 _MAX_RETRIES 重试，所有重试复用同一份消息和 Idempotency-Key
+        Args:
+            msgs: 发送给模型的消息列表
+            kwargs: 传递给 chat.completions.create 的其他参数
+        """
+        if self._create is None or self._create_client.is_closed():
+            self._bind_create()
+        return self._create(
+            messages=msgs,
+            extra_headers={"Idempotency-Key": uuid.uuid4().hex},
+            **kwargs,
+        )
+
+    def stream_chat(self, message: str, coalesce_ms: float = 0) -> Iterator[str]:
         """
         发送消息给LLM并获取流式迭代器
         Args:
             message: 用户输入的消息
+            coalesce_ms: 合并回复片段的时间窗口，单位为毫秒
+                为0时每收到一个 chunk 生成一次（可能为None）；
+                大于0时跳过空内容，并将窗口内收到的片段合并后再生成
         Returns:
             一个可迭代的流式回复生成器，每次迭代生成一个字符串
         """
@@ -199,23 +550,86 @@ class ChatClient:
             raise ValueError("No model selected")
 
         self.conversation_history.append({"role": "user", "content": message})
+        self._trim_history()
 
+        coalesce_interval = coalesce_ms / 1000
+        buffer: List[str] = []
         try:
-            response_stream = self.client.chat.completions.create(
-                model=self.selected_model.name,
-                messages=self.conversation_history,
+            response_stream = self._do_create(
+                list(self.conversation_history),
                 stream=True,
             )
+            # 热循环中每个 token 都会执行一次，将属性查找提前绑定到局部变量，
+            # 并跳过没有 choices 的 chunk（部分服务端会单独发送 usage 信息）
+            if coalesce_interval <= 0:
+                for response_chunk in response_stream:
+                    choices = response_chunk.choices
+                    if choices:
+                        yield choices[0].delta.content
+                return
+
+            monotonic = time.monotonic
+            append = buffer.append
+            join = "".join
+            # 第一个片段立即生成，不增加首字延迟
+            last_yield = float("-inf")
             for response_chunk in response_stream:
-                yield response_chunk.choices[0].delta.content
+                choices = response_chunk.choices
+                if not choices:
+                    continue
+                content = choices[0].delta.content
+                if not content:
+                    continue
+                append(content)
+                now = monotonic()
+                if now - last_yield > coalesce_interval:
+                    yield join(buffer)
+                    buffer.clear()
+                    last_yield = now
         except Exception as e:
             print(f"API 请求失败：{str(e)}")
-            return
+        if buffer:
+            yield "".join(buffer)
+
+    def stream_chat_to(
+        self, message: str, stream: BinaryIO, flush_every_ms: float = 50
+    ) -> str:
+        """
+        发送消息给LLM，并将流式回复写入二进制流
+        回复会先缓冲，缓冲超过 4 KiB 或距上次写入超过 flush_every_ms 时才写入，
+        以减少逐个 chunk 写入带来的系统调用
+        Args:
+            message: 用户输入的消息
+            stream: 可写的二进制流，例如 sys.stdout.buffer
+            flush_every_ms: 两次写入之间的最长间隔，单位为毫秒
+        Returns:
+            完整的回复内容
+        """
+        flush_interval = flush_every_ms / 1000
+        buffer = bytearray()
+        parts: List[str] = []
+        last_flush = time.monotonic()
+        for chunk in self.stream_chat(message):
+            if not chunk:
+                continue
+            parts.append(chunk)
+            buffer += chunk.encode("utf-8")
+            now = time.monotonic()
+            if len(buffer) >= 4096 or now - last_flush > flush_interval:
+                stream.write(bytes(buffer))
+                stream.flush()
+                buffer.clear()
+                last_flush = now
+        if buffer:
+            stream.write(bytes(buffer))
+            stream.flush()
+        return "".join(parts)
 
     def json_chat(self, message: str) -> Dict:
         """
         发送消息给LLM并获取JSON格式的回复
         使用需要设置 system prompt ，并给出希望模型输出的 JSON 格式的样例
+        回复以流式方式接收，安装 ijson 后会在接收的同时增量解析
         Args:
             message: 用户输入的消息
         Returns:
@@ -224,18 +638,32 @@ class ChatClient:
         if not self.selected_model:
             raise ValueError("No model selected")
         self.conversation_history.append({"role": "user", "content": message})
+        self._trim_history()
         try:
-            response = self.client.chat.completions.create(
-                model=self.selected_model.name,
-                messages=self.conversation_history,
-                stream=False,
+            response_stream = self._do_create(
+                list(self.conversation_history),
+                stream=True,
                 response_format={"type": "json_object"},
             )
-            reply_content = response.choices[0].message.content
+            reader = _ChunkReader(
+                response_chunk.choices[0].delta.content
+                for response_chunk in response_stream
+                if response_chunk.choices
+            )
+            # 在接收回复的同时增量解析，解析失败时退化为对完整回复的整体解析
+            result = None
+            if ijson is not None:
+                try:
+                    result = next(ijson.items(reader, "", use_float=True), None)
+                except ijson.JSONError:
+                    result = None
+            reply_content = reader.drain()
             self.conversation_history.append(
                 {"role": "assistant", "content": reply_content}
             )
-            return json.loads(reply_content)
+            if result is None:
+                result = _json_loads(reply_content)
+            return result
         except json.JSONDecodeError:
             print("错误：模型返回的内容无法解析为JSON")
             return {}
@@ -243,13 +671,198 @@ class ChatClient:
             print(f"API 请求失败：{str(e)}")
             return
 
+    async def achat(
+        self, message: str, history: Optional[MutableSequence[Dict]] = None
+    ) -> str:
+        """
+        chat 的异步版本
+        指定 history 时在该历史上进行对话，不会修改 self.conversation_history，
+        便于多个请求并发执行
+        Args:
+            message: 用户输入的消息
+            history: 本次请求使用的对话历史，为None时使用并更新当前的对话历史
+        Returns:
+            LLM的回复
+        """
+        if not self.selected_model:
+            raise ValueError("No model selected")
+
+        async with self._new_async_client() as async_client:
+            return await self._achat(async_client, message, history)
+
+    def _new_async_client(self) -> AsyncOpenAI:
+        """
+        创建当前模型对应的 AsyncOpenAI client
+        其连接池与首次使用它的事件循环绑定，而 asyncio.run 每次都会创建新的事件循环，
+        因此不跨调用缓存，由调用方在使用完毕后关闭
+        """
+        return AsyncOpenAI(
+            api_key=self.selected_model.api_key, base_url=self.selected_model.url
+        )
+
+    async def _achat(
+        self,
+        async_client: AsyncOpenAI,
+        message: str,
+        history: Optional[MutableSequence[Dict]] = None,
+        **kwargs,
+    ) -> str:
+        """
+        使用给定的 async_client 发送消息，message 和 history 与 achat 相同
+        Args:
+            kwargs: 传递给 chat.completions.create 的其他参数
+        """
+        if history is None:
+            history = self.conversation_history
+        history.append({"role": "user", "content": message})
+        self._trim_history(history)
+        try:
+            response = await async_client.chat.completions.create(
+                model=self.selected_model.name,
+                messages=list(history),
+                stream=False,
+                **kwargs,
+            )
+            reply_content = response.choices[0].message.content
+            history.append({"role": "assistant", "content": reply_content})
+            return reply_content
+        except Exception as e:
+            print(f"API 请求失败：{str(e)}")
+            return
+
+    async def chat_many(self, messages: List[str]) -> List[str]:
+        """
+        并发发送多条相互独立的消息
+        每条消息都基于当前对话历史的副本进行对话，不会修改当前的对话历史
+        Args:
+            messages: 用户输入的消息列表
+        Returns:
+            与 messages 顺序一致的回复列表
+        """
+        if not self.selected_model:
+            raise ValueError("No model selected")
+
+        async with self._new_async_client() as async_client:
+            return await asyncio.gather(
+                *[
+                    self._achat(
+                        async_client, message, history=copy(self.conversation_history)
+                    )
+                    for message in messages
+                ]
+            )
+
+    def batched_completions(
+        self, prompts: List[str], max_tokens: int = 256
+    ) -> List[str]:
+        """
+        通过一次请求发送多条相互独立的 prompt
+        使用支持列表 prompt 的 completions 接口，减少请求次数；
+        若服务端不支持该接口，则退化为并发的 chat 请求
+        注意：这些请求都是无状态的，不会使用也不会修改对话历史
+        退化时会调用 asyncio.run，已处于事件循环中时请使用 abatched_completions
+        Args:
+            prompts: prompt 列表
+            max_tokens: 每条回复的最大 token 数
+        Returns:
+            与 prompts 顺序一致的回复列表
+        """
+        if not self.selected_model:
+            raise ValueError("No model selected")
+
+        try:
+            response = self._selected_client().completions.create(
+                model=self.selected_model.name,
+                prompt=prompts,
+                max_tokens=max_tokens,
+            )
+        except _COMPLETIONS_UNSUPPORTED_ERRORS as e:
+            print(f"completions 接口请求失败，改用 chat 接口：{str(e)}")
+            return asyncio.run(self._achat_stateless(prompts, max_tokens=max_tokens))
+        except Exception as e:
+            print(f"API 请求失败：{str(e)}")
+            return
+        return self._replies_by_index(prompts, response)
+
+    async def abatched_completions(
+        self, prompts: List[str], max_tokens: int = 256
+    ) -> List[str]:
+        """
+        batched_completions 的异步版本，供已处于事件循环中的调用方使用
+        Args:
+            prompts: prompt 列表
+            max_tokens: 每条回复的最大 token 数
+        Returns:
+            与 prompts 顺序一致的回复列表
+        """
+        if not self.selected_model:
+            raise ValueError("No model selected")
+
+        async with self._new_async_client() as async_client:
+            try:
+                response = await async_client.completions.create(
+                    model=self.selected_model.name,
+                    prompt=prompts,
+                    max_tokens=max_tokens,
+                )
+            except _COMPLETIONS_UNSUPPORTED_ERRORS as e:
+                print(f"completions 接口请求失败，改用 chat 接口：{str(e)}")
+                return await self._achat_stateless(
+                    prompts, async_client, max_tokens=max_tokens
+                )
+            except Exception as e:
+                print(f"API 请求失败：{str(e)}")
+                return
+        return self._replies_by_index(prompts, response)
+
+    @staticmethod
+    def _replies_by_index(prompts: List[str], response) -> List[str]:
+        """按 choice.index 将 completions 的回复对应回 prompts 的顺序"""
+        replies = [None] * len(prompts)
+        for choice in response.choices:
+            replies[choice.index] = choice.text
+        return replies
+
+    async def _achat_stateless(
+        self,
+        prompts: List[str],
+        async_client: Optional[AsyncOpenAI] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[str]:
+        """
+        并发发送多条无历史的消息
+        Args:
+            async_client: 使用的 client，为None时创建一个新的 client
+            max_tokens: 每条回复的最大 token 数，为None时不限制
+        """
+        if async_client is None:
+            async with self._new_async_client() as async_client:
+                return await self._achat_stateless(prompts, async_client, max_tokens)
+        kwargs = {} if max_tokens is None else {"max_tokens": max_tokens}
+        return await asyncio.gather(
+            *[
+                self._achat(async_client, prompt, history=[], **kwargs)
+                for prompt in prompts
+            ]
+        )
+
     def chat_cleanup(self):
         """清理对话历史"""
-        self.conversation_history = []
+        self.conversation_history = self._new_history()
+
+    def _new_history(self) -> Deque[Dict]:
+        """
+        创建空的对话历史
+        不需要保留 system prompt 时，由 deque 的 maxlen 直接丢弃最早的消息；
+        否则 maxlen 会把开头的 system prompt 一并丢弃，改由 _trim_history 截断
+        """
+        if self.max_history_turns is None or self.preserve_system:
+            return collections.deque()
+        return collections.deque(maxlen=2 * self.max_history_turns)
 
     def get_history(self) -> List[Dict]:
-        """获取当前的对话历史"""
-        return self.conversation_history
+        """获取当前的对话历史，返回的是列表形式的副本"""
+        return list(self.conversation_history)
 
     def append_history(self, role: str, content: str):
         """
@@ -271,12 +884,140 @@ class ChatClient:
         """
         self.conversation_history.append({"role": "system", "content": content})
 
-    def _check_context_length(self, message: str) -> bool:
-        """检查消息是否超过上下文长度限制"""
-        # TODO: 实现上下文长度检查
-        pass
+    def _trim_history(self, history: Optional[MutableSequence[Dict]] = None) -> None:
+        """
+        截断对话历史：先按滑动窗口只保留最近的 max_history_turns 轮对话，
+        再从最早的消息开始丢弃，直到总 token 数不超过上下文长度限制
+        截断按完整的轮次进行，保留下来的第一条非 system 消息总是用户消息
+        preserve_system 为 True 时，开头的 system prompt 不会被截断
+        截断会直接删除 history 中的消息，而不是只作用于发送给模型的副本
+        Args:
+            history: 需要截断的对话历史，为None时截断当前的对话历史
+        """
+        if history is None:
+            history = self.conversation_history
 
-    def _split_long_message(self, message: str) -> List[str]:
-        """将过长的消息分片"""
-        # TODO: 实现消息分片逻辑
-        pass
+        has_system = bool(
+            self.preserve_system and history and history[0]["role"] == "system"
+        )
+        # 需要丢弃的最早的消息的位置，对 deque 而言删除两端附近的元素是 O(1) 的
+        start = 1 if has_system else 0
+        if self.max_history_turns is not None:
+            max_messages = 2 * self.max_history_turns
+            while len(history) > start + max_messages:
+                del history[start]
+
+        budget = self._context_budget()
+        if budget is not None:
+            total = self._count_tokens(history)
+            # 至少保留最新的一条消息
+            while len(history) > start + 1 and total > budget:
+                total -= self._message_tokens(history[start])
+                del history[start]
+
+        # 丢弃被截断的轮次中剩下的回复，部分服务端不接受以 assistant 消息开头的对话
+        while len(history) > start + 1 and history[start]["role"] != "user":
+            del history[start]
+
+    def close(self) -> None:
+        """
+        关闭所有缓存的 client 及共享的 HTTP 连接
+        client 在所有 ChatClient 实例之间共享，其他实例在下次请求时会自动重新建立连接
+        """
+        global _shared_http_client
+        for client in _CLIENT_CACHE.values():
+            client.close()
+        _CLIENT_CACHE.clear()
+        if _shared_http_client is not None:
+            _shared_http_client.close()
+            _shared_http_client = None
+        self._clients.clear()
+        self._create = None
+        self._create_client = None
+
+    def _encode(self, text: str) -> List:
+        """
+        将文本编码为 token 序列
+        未安装 tiktoken 或编码加载失败时按字符切分，每个字符视为一个 token
+        """
+        encoding = self._get_model_encoding()
+        if encoding is None:
+            return list(text)
+        return encoding.encode(text)
+
+    def _decode(self, tokens: List) -> str:
+        """将 token 序列解码为文本"""
+        encoding = self._get_model_encoding()
+        if encoding is None:
+            return "".join(tokens)
+        return encoding.decode(tokens)
+
+    def _get_model_encoding(self):
+        """
+        获取当前模型的 tiktoken 编码，只在第一次需要计算 token 时加载
+        加载结果（包括失败）按模型缓存，保证同一模型的编码与解码一致
+        """
+        model_name = self.selected_model.name if self.selected_model else None
+        if self._encoding_model != model_name:
+            self._encoding = _get_encoding(model_name) if model_name else None
+            self._encoding_model = model_name
+        return self._encoding
+
+    def _count_tokens(self, history: Optional[Sequence[Dict]] = None) -> int:
+        """
+        估算对话历史的 token 数
+        Args:
+            history: 需要估算的对话历史，为None时使用当前的对话历史
+        """
+        if history is None:
+            history = self.conversation_history
+        return sum(self._message_tokens(message) for message in history)
+
+    def _message_tokens(self, message: Dict) -> int:
+        """估算单条消息的 token 数"""
+        return len(self._encode(message["content"] or "")) + _TOKENS_PER_MESSAGE
+
+    def _context_budget(self) -> Optional[int]:
+        """可用于输入的 token 数，未设置上下文长度时返回None"""
+        if self.max_context_tokens is None:
+            return None
+        return self.max_context_tokens - self.reserved_output_tokens
+
+    def _check_context_length(
+        self, history: Optional[Sequence[Dict]] = None
+    ) -> bool:
+        """
+        检查对话历史是否在上下文长度限制内
+        Args:
+            history: 需要检查的对话历史，为None时使用当前的对话历史
+        Returns:
+            未超过限制时返回True
+        """
+        budget = self._context_budget()
+        if budget is None:
+            return True
+        return self._count_tokens(history) <= budget
+
+    def _split_long_message(
+        self, message: str, max_tokens: Optional[int] = None
+    ) -> List[str]:
+        """
+        将过长的消息按 token 数分片
+        Args:
+            message: 需要分片的消息
+            max_tokens: 每个分片的最大 token 数，为None时使用上下文长度限制
+        Returns:
+            分片后的消息列表
+        """
+        if max_tokens is None:
+            max_tokens = self._context_budget()
+            if max_tokens is not None:
+                max_tokens -= _TOKENS_PER_MESSAGE
+        if max_tokens is None or max_tokens <= 0:
+            return [message]
+
+        tokens = self._encode(message)
+        return [
+            self._decode(tokens[i : i + max_tokens])
+            for i in range(0, len(tokens), max_tokens)
+        ] or [message]
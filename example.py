@@ -1,3 +1,5 @@
+import sys
+
 from ChatClient import ChatClient
 
 if __name__ == "__main__":
@@ -29,11 +31,8 @@ if __name__ == "__main__":
     client.set_system_prompt(
         "You are a cat, so whatever I say, respond like a cat would."
     )
-    stream_response = client.stream_chat(user_input)
-    print("\nStreaming response:")
-    for chunk in stream_response:
-        if chunk:
-            print(chunk, end="", flush=True)
+    print("\nStreaming response:", flush=True)
+    client.stream_chat_to(user_input, sys.stdout.buffer)
 
     # json chat example and init from env
     print("\n\nRe-initializing ChatClient from environment variables.")